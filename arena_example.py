@@ -3,10 +3,13 @@ import openai
 import base64
 import os
 import datetime
-import wave
-import io
+import atexit
+import functools
+import struct
 import json
-import numpy as np
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import soundfile as sf
 from torchmetrics.audio import DeepNoiseSuppressionMeanOpinionScore
@@ -15,40 +18,114 @@ from torchmetrics.audio import DeepNoiseSuppressionMeanOpinionScore
 # MOS Evaluation Helper Functions
 # =============================
 
-def evaluate_mos_for_audio(pred_audio_path, ref_audio_path):
+# Device passed to DNSMOS, which runs ONNX Runtime sessions: it asks for the CUDA execution
+# provider when torch sees a GPU, but inference only runs there if onnxruntime-gpu is
+# installed (otherwise ONNX Runtime falls back to the CPU). DNSMOS needs an indexed
+# "cuda:n" device to set the provider's device_id. Input tensors always stay on the CPU.
+MOS_DEVICE = f"cuda:{torch.cuda.current_device()}" if torch.cuda.is_available() else "cpu"
+
+# Sampling rate of the evaluated audio (GPT‑4o audio output is 24 kHz WAV) and whether to
+# use the personalized DNSMOS model, which penalizes interfering speakers.
+MOS_SAMPLE_RATE = 24000
+MOS_PERSONALIZED = False
+
+# Number of threads used to load audio files in parallel.
+AUDIO_IO_WORKERS = 8
+
+# Buffer size used when streaming the concatenated conversation WAV to disk.
+WAV_WRITE_BUFFER_SIZE = 1 << 20
+
+# Maximum number of decoded audio files kept in memory by _load_audio.
+AUDIO_CACHE_SIZE = 256
+
+# Cached MOS metric instance; built on first use so the DNSMOS weights are loaded only once.
+_MOS_METRIC = None
+
+
+def _get_mos_metric():
+    """
+    Return the shared DeepNoiseSuppressionMeanOpinionScore instance on MOS_DEVICE,
+    creating it on first call.
     """
-    Compute the MOS (Mean Opinion Score) for one pair of synthesized (predicted) and reference audio.
-    Expects both audio files to have the same sampling rate.
+    global _MOS_METRIC
+    if _MOS_METRIC is None:
+        metric = DeepNoiseSuppressionMeanOpinionScore(
+            fs=MOS_SAMPLE_RATE, personalized=MOS_PERSONALIZED, device=MOS_DEVICE
+        )
+        # Warm up with one dummy call so the first real batch does not pay for
+        # inference-session setup. The dummy is one second of silence at the metric's fs.
+        dummy = torch.zeros(1, MOS_SAMPLE_RATE)
+        with torch.inference_mode():
+            metric(dummy)
+        metric.reset()
+        _MOS_METRIC = metric
+    return _MOS_METRIC
+
+
+@functools.lru_cache(maxsize=AUDIO_CACHE_SIZE)
+def _load_audio(audio_path, mtime):
+    """
+    Load an audio file as a CPU float32 tensor, returning (tensor, sample_rate).
+    The file's modification time is part of the cache key so rewritten files are re-read.
+    """
+    # Decode straight to float32 rather than soundfile's float64 default.
+    audio, sample_rate = sf.read(audio_path, dtype="float32")
+    # sf.read returns a contiguous array, so the tensor can share its memory. The tensor
+    # stays on the CPU: DNSMOS converts its input to numpy for ONNX Runtime anyway.
+    return torch.from_numpy(audio), sample_rate
+
+
+def _load_audio_pair(pred_audio_path, ref_audio_path):
+    """
+    Check one pair of predicted and reference audio files and load the predicted audio.
+    DNSMOS is non-intrusive, so the reference is only checked, never decoded.
+    Returns the predicted audio tensor, or None if the pair cannot be evaluated.
     """
     try:
-        # Load the audio files using soundfile.
-        pred_audio, sr_pred = sf.read(pred_audio_path)
-        ref_audio, sr_ref = sf.read(ref_audio_path)
+        # Compare sampling rates from the file headers before decoding any audio.
+        sr_pred = sf.info(pred_audio_path).samplerate
+        if sr_pred != sf.info(ref_audio_path).samplerate:
+            print(f"Sampling rate mismatch for files {pred_audio_path} and {ref_audio_path}.")
+            return None
+        if sr_pred != MOS_SAMPLE_RATE:
+            print(f"Unexpected sampling rate {sr_pred} Hz for {pred_audio_path} (expected {MOS_SAMPLE_RATE} Hz).")
+            return None
+
+        # Load the audio file through the cache, keyed on path and modification time.
+        pred_audio, _ = _load_audio(pred_audio_path, os.path.getmtime(pred_audio_path))
     except Exception as e:
         print(f"Error reading audio files for {pred_audio_path} / {ref_audio_path}: {e}")
         return None
 
-    if sr_pred != sr_ref:
-        print(f"Sampling rate mismatch for files {pred_audio_path} and {ref_audio_path}.")
-        return None
-
-    # Convert audio arrays into torch tensors and add a batch dimension.
-    # The DeepNoiseSuppressionMeanOpinionScore metric expects input shape [batch, time].
-    pred_tensor = torch.tensor(pred_audio).unsqueeze(0)
-    ref_tensor = torch.tensor(ref_audio).unsqueeze(0)
+    return pred_audio
 
-    # Initialize the MOS metric.
-    mos_metric = DeepNoiseSuppressionMeanOpinionScore()
 
-    # Compute and return the MOS score as a float.
-    score = mos_metric(pred_tensor, ref_tensor)
-    return score.item()
+def _score_mos_clips(pred_audios):
+    """
+    Run the cached MOS metric over predicted audio clips and return their mean overall MOS.
+    Each clip is fed to the metric at its own length; zero-padding clips into one batch
+    would make DNSMOS score the padding as silence.
+    """
+    # Reuse the cached MOS metric; its running state averages the per-clip scores.
+    mos_metric = _get_mos_metric()
+    with torch.inference_mode():
+        for pred_audio in pred_audios:
+            # The DeepNoiseSuppressionMeanOpinionScore metric expects input shape [batch, time].
+            mos_metric.update(pred_audio.unsqueeze(0))
+        # compute() returns the mean [p808_mos, mos_sig, mos_bak, mos_ovr]; report the overall MOS.
+        score = mos_metric.compute()[-1].item()
+    # Clear the metric state for the next set of clips.
+    mos_metric.reset()
+    return score
 
 
 def evaluate_mos_for_all_speakers(speaker_audio_mapping):
     """
     Evaluate the MOS score for each audio sample per speaker and then average the scores.
 
+    All audio pairs are loaded first; each speaker's clips are then scored one by one and
+    averaged in the metric's running state.
+
     Args:
         speaker_audio_mapping (dict): Mapping of speaker IDs to lists of tuples.
             Each tuple is structured as (pred_audio_path, ref_audio_path).
@@ -56,19 +133,106 @@ def evaluate_mos_for_all_speakers(speaker_audio_mapping):
     Returns:
         dict: Mapping from speaker ID to averaged MOS score.
     """
-    speaker_mos_results = {}
+    # Load every audio pair in parallel before running any inference.
+    all_pairs = [pair for audio_pairs in speaker_audio_mapping.values() for pair in audio_pairs]
+    with ThreadPoolExecutor(max_workers=AUDIO_IO_WORKERS) as executor:
+        loaded_audios = iter(executor.map(lambda pair: _load_audio_pair(*pair), all_pairs))
+
+    speaker_batches = {}
     for speaker, audio_pairs in speaker_audio_mapping.items():
-        scores = []
+        pred_audios = []
         for pred_path, ref_path in audio_pairs:
-            score = evaluate_mos_for_audio(pred_path, ref_path)
-            if score is not None:
-                scores.append(score)
+            pred_audio = next(loaded_audios)
+            if pred_audio is not None:
+                pred_audios.append(pred_audio)
             else:
                 print(f"Skipping MOS evaluation for speaker '{speaker}' for audio pair: {pred_path}, {ref_path}")
-        avg_score = float(np.mean(scores)) if scores else None
+        speaker_batches[speaker] = pred_audios
+
+    speaker_mos_results = {}
+    for speaker, pred_audios in speaker_batches.items():
+        avg_score = _score_mos_clips(pred_audios) if pred_audios else None
         speaker_mos_results[speaker] = avg_score
     return speaker_mos_results
 
+
+def _write_bytes(path, data):
+    """
+    Write raw bytes to a file with os.write, looping until every byte is written.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        remaining = memoryview(data)
+        while remaining:
+            remaining = remaining[os.write(fd, remaining):]
+    finally:
+        os.close(fd)
+
+
+def _audio_writer(write_queue, errors):
+    """
+    Background writer: drain (path, bytes) items from write_queue until a None sentinel.
+    Any write failure is printed and recorded in errors so the main thread can re-raise it.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        path, data = item
+        try:
+            _write_bytes(path, data)
+        except Exception as e:
+            print(f"Error writing audio file {path}: {e}")
+            errors.append(e)
+
+
+def _stop_audio_writer(write_queue, writer_thread):
+    """
+    Post the None sentinel and wait for the writer to finish every queued item.
+    Registered with atexit so queued audio is still written if the script exits early.
+    """
+    if writer_thread.is_alive():
+        write_queue.put(None)
+        writer_thread.join()
+
+# =============================
+# WAV Concatenation Helper Functions
+# =============================
+
+def _find_wav_chunk(wav_bytes, chunk_id):
+    """
+    Return the payload of the first RIFF chunk with the given 4-byte ID.
+    """
+    offset = 12  # skip the "RIFF" <size> "WAVE" file header
+    while offset + 8 <= len(wav_bytes):
+        current_id = wav_bytes[offset:offset + 4]
+        chunk_size = struct.unpack_from("<I", wav_bytes, offset + 4)[0]
+        payload_start = offset + 8
+        if current_id == chunk_id:
+            return memoryview(wav_bytes)[payload_start:payload_start + chunk_size]
+        # Chunks are word-aligned, so odd-sized chunks carry one pad byte.
+        offset = payload_start + chunk_size + (chunk_size & 1)
+    raise ValueError(f"WAV data has no {chunk_id!r} chunk")
+
+
+def _extract_data_chunk(wav_bytes):
+    """
+    Return the raw PCM payload of a WAV file's data chunk without re-parsing frames.
+    """
+    return _find_wav_chunk(wav_bytes, b"data")
+
+
+def _build_wav_header(fmt_chunk, data_len):
+    """
+    Build a RIFF/WAVE header for the given fmt chunk payload and PCM data length.
+    """
+    riff_size = 4 + (8 + len(fmt_chunk)) + (8 + data_len)
+    return (
+        struct.pack("<4sI4s", b"RIFF", riff_size, b"WAVE")
+        + struct.pack("<4sI", b"fmt ", len(fmt_chunk)) + bytes(fmt_chunk)
+        + struct.pack("<4sI", b"data", data_len)
+    )
+
 # =============================
 # Original GPT‑4o Conversation and Evaluation Code
 # =============================
@@ -89,6 +253,26 @@ audio_folder = f"audio_{timestamp}"
 os.makedirs(audio_folder, exist_ok=True)
 print(f"Audio files and logs will be saved to folder: {audio_folder}\n")
 
+# Per-speaker path templates for the generated turns and their ground-truth references,
+# filled in with the turn index
+pred_path_templates = {s: os.path.join(audio_folder, f"speaker{s}_turn%d.wav") for s in (1, 2)}
+ref_path_templates = {s: os.path.join("ground_truth", f"speaker{s}_turn%d.wav") for s in (1, 2)}
+
+# Background writer thread for per-turn audio files, so disk I/O overlaps the API calls
+audio_write_queue = queue.Queue()
+audio_write_errors = []
+audio_writer_thread = threading.Thread(
+    target=_audio_writer, args=(audio_write_queue, audio_write_errors), daemon=True
+)
+audio_writer_thread.start()
+# atexit handlers run before daemon threads are torn down, so pending writes are flushed
+# even if a later section raises before the writer is joined in section 7.
+atexit.register(_stop_audio_writer, audio_write_queue, audio_writer_thread)
+
+# Load the MOS metric in the background so its model setup overlaps the API calls below
+mos_init_executor = ThreadPoolExecutor(max_workers=1)
+mos_metric_future = mos_init_executor.submit(_get_mos_metric)
+
 # *** 1. Generate a creative conversation topic using GPT‑4o (text only) ***
 topic_prompt_system = "You are a creative assistant who invents conversation topics."
 topic_prompt_user = (
@@ -113,7 +297,7 @@ print(topic_narrative)
 print("====================================\n")
 
 # *** 2. Initialize conversation state ***
-conversation_audio_history = []   # list to store audio (binary) of each turn
+conversation_audio_history = []   # list to store (audio bytes, base64 string) of each turn
 conversation_text_history = []    # list to store text transcript of each turn for reference
 
 # Define personas or style hints for each speaker (optional)
@@ -123,35 +307,36 @@ speaker2_persona = None
 # speaker1_persona = "Speaker 1 is thoughtful and calm."
 # speaker2_persona = "Speaker 2 is energetic and curious."
 
+# Compose each speaker's system message (context and role) once; it is the same every turn
+system_messages = {}
+for speaker_num, persona in ((1, speaker1_persona), (2, speaker2_persona)):
+    role_instruction = f"You are Speaker {speaker_num}."
+    if persona:
+        role_instruction += " " + persona
+    role_instruction += " Respond to the conversation in character."
+    system_messages[speaker_num] = (
+        f"Conversation Topic:\n{topic_narrative}\n\n"
+        f"{role_instruction}"
+    )
+
 # *** 3. Simulate a 6-turn dialogue (3 turns per speaker) ***
 num_turns = 6
 for turn_index in range(1, num_turns + 1):
     current_speaker = 1 if turn_index % 2 == 1 else 2
-    # Choose voice for current speaker
+    # Choose voice and system message for current speaker
     voice = voice_speaker1 if current_speaker == 1 else voice_speaker2
-
-    # Compose the system message with context and role
-    role_instruction = f"You are Speaker {current_speaker}."
-    if current_speaker == 1 and speaker1_persona:
-        role_instruction += " " + speaker1_persona
-    if current_speaker == 2 and speaker2_persona:
-        role_instruction += " " + speaker2_persona
-    role_instruction += " Respond to the conversation in character."
-    system_message = (
-        f"Conversation Topic:\n{topic_narrative}\n\n"
-        f"{role_instruction}"
-    )
+    system_message = system_messages[current_speaker]
 
     # Compose the user message content with optional previous audio context
     user_content_segments = []
     user_content_segments.append({"type": "text", "text": "Speak now. (no more than 30 words)"})
     if conversation_audio_history:
         user_content_segments.append({"type": "text", "text": "Previous conversation audio:"})
-        for audio_data in conversation_audio_history:
+        for _, audio_b64 in conversation_audio_history:
             user_content_segments.append({
                 "type": "input_audio",
                 "input_audio": {
-                    "data": base64.b64encode(audio_data).decode('utf-8'),
+                    "data": audio_b64,
                     "format": "wav"
                 }
             })
@@ -171,18 +356,18 @@ for turn_index in range(1, num_turns + 1):
         text_output = assistant_msg["content"]
     else:
         text_output = assistant_msg["audio"]["transcript"]
+    # Keep the base64 string from the response so the audio is never re-encoded
     audio_base64 = assistant_msg["audio"]["data"]
     audio_bytes = base64.b64decode(audio_base64)
 
     # Save transcript and audio output in the conversation state lists
     conversation_text_history.append(f"Speaker {current_speaker}: {text_output}")
-    conversation_audio_history.append(audio_bytes)
+    conversation_audio_history.append((audio_bytes, audio_base64))
     
     # Save the individual audio file in the timestamped folder
-    filename = os.path.join(audio_folder, f"speaker{current_speaker}_turn{turn_index}.wav")
-    with open(filename, "wb") as f:
-        f.write(audio_bytes)
-    print(f"(Saved audio for Speaker {current_speaker}'s turn {turn_index} to {filename})")
+    filename = pred_path_templates[current_speaker] % turn_index
+    audio_write_queue.put((filename, audio_bytes))
+    print(f"(Saving audio for Speaker {current_speaker}'s turn {turn_index} to {filename})")
     print(f"Speaker {current_speaker} (turn {turn_index}): {text_output}\n")
 
 print("Dialogue completed. Proceeding to evaluation...\n")
@@ -204,13 +389,13 @@ evaluation_system_prompt = (
     "... (and so on for Speaker 1, then Speaker 2) ..."
 )
 evaluation_user_content = []
-for idx, audio_bytes in enumerate(conversation_audio_history, start=1):
+for idx, (_, audio_b64) in enumerate(conversation_audio_history, start=1):
     spk = 1 if idx % 2 == 1 else 2
     evaluation_user_content.append({"type": "text", "text": f"Speaker {spk}, Turn {idx}:"})
     evaluation_user_content.append({
         "type": "input_audio",
         "input_audio": {
-            "data": base64.b64encode(audio_bytes).decode('utf-8'),
+            "data": audio_b64,
             "format": "wav"
         }
     })
@@ -231,26 +416,24 @@ print(evaluation_report)
 
 # *** 5. Concatenate all audio files into one "total_conversation.wav" ***
 if conversation_audio_history:
-    # Get parameters from the first audio file and reset the frame count (nframes) to 0
-    first_wav_io = io.BytesIO(conversation_audio_history[0])
-    with wave.open(first_wav_io, 'rb') as w:
-        params = w.getparams()
-    # Reset the number of frames to 0 so that total frames are counted correctly
-    params = params._replace(nframes=0)
+    # All turns share the same format, so take the fmt chunk from the first file and
+    # stream the PCM payload of every turn straight to disk behind a single header.
+    fmt_chunk = _find_wav_chunk(conversation_audio_history[0][0], b"fmt ")
 
     total_wav_path = os.path.join(audio_folder, "total_conversation.wav")
-    with wave.open(total_wav_path, 'wb') as total_wav:
-        total_wav.setparams(params)
-        for wav_bytes in conversation_audio_history:
-            wav_io = io.BytesIO(wav_bytes)
-            with wave.open(wav_io, 'rb') as w:
-                frames = w.readframes(w.getnframes())
-                total_wav.writeframes(frames)
+    with open(total_wav_path, "wb", buffering=WAV_WRITE_BUFFER_SIZE) as f:
+        # Write a placeholder header, then rewrite it once the data size is known.
+        f.write(_build_wav_header(fmt_chunk, 0))
+        data_len = 0
+        for wav_bytes, _ in conversation_audio_history:
+            data_len += f.write(_extract_data_chunk(wav_bytes))
+        f.seek(0)
+        f.write(_build_wav_header(fmt_chunk, data_len))
     print(f"(Saved total concatenated conversation to {total_wav_path})\n")
 
 # *** 6. Create text files with organized conversation details and evaluation report ***
 # Conversation details file
-details_content = (
+details_parts = [
     "=== Conversation Details ===\n\n"
     "Topic:\n"
     f"{topic_narrative}\n\n"
@@ -258,9 +441,9 @@ details_content = (
     f"Speaker 1: {speaker1_persona}\n"
     f"Speaker 2: {speaker2_persona}\n\n"
     "Transcript:\n"
-)
-for transcript in conversation_text_history:
-    details_content += transcript + "\n"
+]
+details_parts.extend(transcript + "\n" for transcript in conversation_text_history)
+details_content = "".join(details_parts)
 
 details_file_path = os.path.join(audio_folder, "conversation_details.txt")
 with open(details_file_path, "w") as f:
@@ -281,18 +464,28 @@ print(f"(Saved evaluation report to {evaluation_file_path})")
 # 7. Perform MOS Evaluation and Save Combined Results
 # =============================
 
+# Make sure every per-turn audio file has been written, and the MOS metric has finished
+# loading, before reading them back.
+audio_write_queue.put(None)
+audio_writer_thread.join()
+if audio_write_errors:
+    raise audio_write_errors[0]
+mos_metric_future.result()
+mos_init_executor.shutdown()
+
 # Build a mapping from each speaker to the list of (predicted, reference) audio file pairs.
 # Here we assume that each synthesized audio turn has a corresponding ground truth audio file
 # in a folder called "ground_truth" with a similar naming pattern.
 speaker_audio_mapping = {"speaker1": [], "speaker2": []}
 for turn_index in range(1, num_turns + 1):
     # Determine speaker based on turn index.
-    speaker = "speaker1" if turn_index % 2 == 1 else "speaker2"
-    # Predicted audio file is saved in the audio_folder.
-    pred_audio_path = os.path.join(audio_folder, f"{speaker}_turn{turn_index}.wav")
-    # Reference (ground truth) audio file is assumed to be in the "ground_truth" folder.
-    ref_audio_path = os.path.join("ground_truth", f"{speaker}_turn{turn_index}.wav")
-    speaker_audio_mapping[speaker].append((pred_audio_path, ref_audio_path))
+    speaker_num = 1 if turn_index % 2 == 1 else 2
+    # Predicted audio is saved in the audio_folder; the reference (ground truth) audio
+    # is assumed to be in the "ground_truth" folder.
+    speaker_audio_mapping[f"speaker{speaker_num}"].append((
+        pred_path_templates[speaker_num] % turn_index,
+        ref_path_templates[speaker_num] % turn_index,
+    ))
 
 # Evaluate the MOS scores for each speaker.
 mos_results = evaluate_mos_for_all_speakers(speaker_audio_mapping)